@@ -17,41 +17,70 @@ Features:
     - Supports MP3 and OGG content types
     - Graceful shutdown via /shutdown endpoint
     - Connection drop simulation for reconnect testing
+    - Stream pacing at the reported bitrate (disable with MOCK_NO_PACING=1)
+    - HEAD probes on stream paths answered without streaming; unknown paths return 404
 """
 
 import argparse
+import functools
+import json
 import os
 import signal
 import socket
 import sys
 import threading
 import time
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 
 # Default configuration
 DEFAULT_PORT = 8765
 DEFAULT_META_INTERVAL = 8192
 DEFAULT_BITRATE = 128
+DEFAULT_MAX_CLIENTS = 32
+POLL_INTERVAL = 0.1  # Seconds between shutdown checks in the accept loop
+STREAM_CHUNK_SIZE = 4096  # Chunk size when no ICY metadata is requested
+SEND_BUFFER_SIZE = 1 << 20  # Socket send buffer for streaming connections
+SEND_BATCH = 16  # Chunks per send call when streaming without pacing
+WORKER_STACK_SIZE = 512 * 1024  # Handler threads only need a shallow stack
+
+# ICY metadata is padded to a 16-byte boundary, so padding is at most 15 bytes
+_ZEROS = b'\x00' * 16
 
 # Global server instance for shutdown handling
 _server_instance = None
-_shutdown_event = threading.Event()
 
 
 class MockStreamHandler(BaseHTTPRequestHandler):
     """HTTP handler that simulates Icecast/Shoutcast streaming server."""
 
-    # Class-level configuration (set by server setup)
-    stream_file = None
-    meta_interval = DEFAULT_META_INTERVAL
-    station_name = "Test Radio Station"
-    station_url = "http://localhost:8765"
-    bitrate = DEFAULT_BITRATE
-    content_type = "audio/mpeg"
-    drop_after_bytes = 0  # 0 = don't drop, >0 = drop after N bytes
-    metadata_sequence = []  # List of metadata strings to cycle through
+    # Send small writes such as the ICY headers without Nagle delays
+    disable_nagle_algorithm = True
+
+    _dummy_bytes = None  # Fallback data when no fixture file is available
+
+    def setup(self):
+        """Tune the connection and pick up the server's configuration."""
+        super().setup()
+        # Enlarge the send buffer so whole chunks fit in one send
+        self.request.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+
+        # Copy the settings of the server that accepted this connection
+        server = self.server
+        self.meta_interval = server.meta_interval
+        self.bitrate = server.bitrate
+        self.content_type = server.content_type
+        self.drop_after_bytes = server.drop_after_bytes
+        self._stream_fd = server._stream_fd
+        self._stream_len = server._stream_len
+        self._ring_bytes = server._ring_bytes
+        self._encoded_meta = server._encoded_meta
+        self._icy_headers_plain = server._icy_headers_plain
+        self._icy_headers_meta = server._icy_headers_meta
+        self._config_json = server._config_json
+        self._shutdown_event = server._shutdown_event
+        self._stream_slots = server._stream_slots
+        self.no_pacing = server.no_pacing
 
     def log_message(self, format, *args):
         """Suppress default logging unless DEBUG env var is set."""
@@ -67,12 +96,21 @@ class MockStreamHandler(BaseHTTPRequestHandler):
         elif self.path == '/config':
             self._handle_config()
         elif self.path.startswith('/stream'):
-            self._handle_stream()
+            self._handle_stream(drop_connection=False)
         elif self.path == '/drop':
             # Special endpoint that drops connection after sending some data
-            self._handle_drop_stream()
+            self._handle_stream(drop_connection=True)
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        """Handle HEAD requests (probes) without starting a stream."""
+        if self.path.startswith('/stream') or self.path == '/drop':
+            self.send_response(200)
+            self.send_header('Content-Type', self.content_type)
+            self.end_headers()
         else:
-            self._handle_stream()
+            self.send_error(404)
 
     def _handle_shutdown(self):
         """Handle shutdown request."""
@@ -80,7 +118,7 @@ class MockStreamHandler(BaseHTTPRequestHandler):
         self.send_header('Content-Type', 'text/plain')
         self.end_headers()
         self.wfile.write(b'OK\n')
-        _shutdown_event.set()
+        self.server.request_shutdown()
 
     def _handle_status(self):
         """Handle status check request."""
@@ -91,140 +129,155 @@ class MockStreamHandler(BaseHTTPRequestHandler):
 
     def _handle_config(self):
         """Handle configuration request - returns current settings as JSON."""
-        import json
-        config = {
-            'station_name': self.station_name,
-            'bitrate': self.bitrate,
-            'meta_interval': self.meta_interval,
-            'content_type': self.content_type,
-            'drop_after_bytes': self.drop_after_bytes
-        }
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self._config_json)))
         self.end_headers()
-        self.wfile.write(json.dumps(config).encode('utf-8'))
+        self.wfile.write(self._config_json)
 
-    def _handle_stream(self):
+    def _handle_stream(self, drop_connection):
         """Handle stream request - sends ICY response with stream data."""
-        # Check if client wants ICY metadata
-        icy_metadata = self.headers.get('Icy-MetaData', '0') == '1'
+        # Refuse streams over the limit rather than queueing them, so the
+        # control endpoints stay reachable
+        if not self._stream_slots.acquire(blocking=False):
+            self.send_error(503, 'Too many streams')
+            return
 
-        # Send ICY response headers
-        self._send_icy_headers(icy_metadata)
+        try:
+            # Check if client wants ICY metadata
+            icy_metadata = self.headers.get('Icy-MetaData', '0') == '1'
 
-        # Stream the data
-        self._stream_data(icy_metadata, drop_connection=False)
+            # Send ICY response headers
+            self._send_icy_headers(icy_metadata)
 
-    def _handle_drop_stream(self):
-        """Handle stream that intentionally drops connection."""
-        icy_metadata = self.headers.get('Icy-MetaData', '0') == '1'
-        self._send_icy_headers(icy_metadata)
-        self._stream_data(icy_metadata, drop_connection=True)
+            # Stream the data
+            self._stream_data(icy_metadata, drop_connection)
+        finally:
+            self._stream_slots.release()
 
     def _send_icy_headers(self, icy_metadata):
         """Send ICY protocol headers."""
         # Use raw socket write to send ICY response (not HTTP/1.x)
-        response = "ICY 200 OK\r\n"
-        response += f"icy-name:{self.station_name}\r\n"
-        response += f"icy-url:{self.station_url}\r\n"
-        response += f"icy-br:{self.bitrate}\r\n"
-        response += "icy-genre:Test\r\n"
-        response += f"Content-Type:{self.content_type}\r\n"
-
         if icy_metadata:
-            response += f"icy-metaint:{self.meta_interval}\r\n"
-
-        response += "\r\n"
-
-        self.wfile.write(response.encode('utf-8'))
+            self.wfile.write(self._icy_headers_meta)
+        else:
+            self.wfile.write(self._icy_headers_plain)
 
     def _stream_data(self, icy_metadata, drop_connection=False):
         """Stream audio data with optional ICY metadata."""
         # Load stream data
         stream_data = self._load_stream_data()
-        if not stream_data:
-            return
+        stream_len = self._stream_len
+        chunk_size = self.meta_interval if icy_metadata else STREAM_CHUNK_SIZE
 
         bytes_sent = 0
-        bytes_since_meta = 0
         metadata_index = 0
         drop_bytes = self.drop_after_bytes if drop_connection else 0
 
-        try:
-            data_index = 0
-            while not _shutdown_event.is_set():
-                # Calculate how much data to send
-                if icy_metadata:
-                    chunk_size = min(self.meta_interval - bytes_since_meta,
-                                    len(stream_data) - data_index)
-                else:
-                    chunk_size = min(4096, len(stream_data) - data_index)
+        # Pace the stream at the reported bitrate
+        bytes_per_sec = self.bitrate * 1000 // 8
+        pacing = bytes_per_sec > 0 and not self.no_pacing
+        t0 = time.monotonic()
+
+        # Without pacing or a drop point, send several chunks per syscall
+        batch = 1 if pacing or drop_bytes else SEND_BATCH
 
-                if chunk_size <= 0:
-                    # Loop the stream data
-                    data_index = 0
-                    continue
+        # Without metadata the fixture can go from the page cache straight
+        # to the socket via sendfile(), skipping user-space copies
+        stream_fd = None if icy_metadata else self._stream_fd
+        sock_fd = self.request.fileno()
 
+        # Bind what the loop uses to locals to skip attribute lookups, and
+        # pick the gathered send once rather than on every chunk
+        sendfile = os.sendfile if stream_fd is not None else None
+        if hasattr(self.request, 'sendmsg'):
+            send_buffers = functools.partial(self._sendmsg_all, self.request.sendmsg)
+        else:
+            send_buffers = functools.partial(self._sendall_joined, self.request.sendall)
+        encoded_meta = self._encoded_meta
+        meta_count = len(encoded_meta)
+        shutdown_is_set = self._shutdown_event.is_set
+        shutdown_wait = self._shutdown_event.wait
+        monotonic = time.monotonic
+
+        try:
+            pos = 0
+            while not shutdown_is_set():
                 # Check if we should drop the connection
                 if drop_bytes > 0 and bytes_sent >= drop_bytes:
                     return  # Abruptly close connection
 
-                # Send audio data chunk
-                chunk = stream_data[data_index:data_index + chunk_size]
-                self.wfile.write(chunk)
-                self.wfile.flush()
-
-                data_index += chunk_size
-                bytes_sent += chunk_size
-                bytes_since_meta += chunk_size
-
-                # Insert metadata if needed
-                if icy_metadata and bytes_since_meta >= self.meta_interval:
-                    self._send_metadata(metadata_index)
-                    if self.metadata_sequence:
-                        metadata_index = (metadata_index + 1) % len(self.metadata_sequence)
-                    bytes_since_meta = 0
-
-                # Small delay to simulate realistic streaming
-                time.sleep(0.01)
+                if stream_fd is not None:
+                    # Stop at the end of the file and wrap on the next send
+                    sent = sendfile(sock_fd, stream_fd, pos,
+                                    min(batch * chunk_size, stream_len - pos))
+                    if not sent:
+                        raise RuntimeError('stream fixture shrank while streaming')
+                else:
+                    # The stream data extends past its end with wrapped-around
+                    # data, so every chunk is one slice; slicing the
+                    # memoryview doesn't copy it. Chunks and their metadata
+                    # blocks go out together in one gathered send
+                    buffers = []
+                    for i in range(batch):
+                        start = (pos + i * chunk_size) % stream_len
+                        buffers.append(stream_data[start:start + chunk_size])
+                        if icy_metadata:
+                            buffers.append(encoded_meta[metadata_index])
+                            metadata_index = (metadata_index + 1) % meta_count
+
+                    send_buffers(buffers)
+                    sent = batch * chunk_size
+
+                pos = (pos + sent) % stream_len
+                bytes_sent += sent
+
+                # Wait until the audio sent so far is due at the bitrate,
+                # waking early if the server shuts down
+                if pacing:
+                    dt = t0 + bytes_sent / bytes_per_sec - monotonic()
+                    if dt > 0:
+                        shutdown_wait(dt)
 
         except (BrokenPipeError, ConnectionResetError):
             pass  # Client disconnected
 
+    @staticmethod
+    def _sendall_joined(sendall, buffers):
+        """Send buffers in order as one joined write."""
+        sendall(b''.join(buffers))
+
+    @staticmethod
+    def _sendmsg_all(sendmsg, buffers):
+        """Send buffers in order, gathering them into as few calls as possible."""
+        while buffers:
+            sent = sendmsg(buffers)
+            # Drop fully sent buffers and resume inside a partial one
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = buffers[0][sent:]
+
     def _load_stream_data(self):
-        """Load stream data from fixture file or generate dummy data."""
-        if self.stream_file and os.path.exists(self.stream_file):
-            with open(self.stream_file, 'rb') as f:
-                return f.read()
-        else:
-            # Generate dummy MP3-like frame data
-            # Simple pattern that looks like MP3 frame headers
-            return self._generate_dummy_mp3_data(64 * 1024)  # 64KB of dummy data
+        """Return the stream data shared by all connections."""
+        return memoryview(self._ring_bytes)
 
-    def _generate_dummy_mp3_data(self, size):
+    @staticmethod
+    def _generate_dummy_mp3_data(size):
         """Generate dummy data that resembles MP3 frames."""
         # MP3 frame sync word: 0xFF 0xFB (MPEG1 Layer3)
         # Frame size for 128kbps @ 44100Hz = 417 bytes
         frame_size = 417
         frame_header = bytes([0xFF, 0xFB, 0x90, 0x00])  # MP3 frame header
 
-        data = BytesIO()
-        while data.tell() < size:
-            # Write frame header
-            data.write(frame_header)
-            # Write frame padding (zeros would work, but use pattern for visibility)
-            padding_size = frame_size - len(frame_header)
-            data.write(bytes([0x00] * padding_size))
-
-        return data.getvalue()[:size]
-
-    def _send_metadata(self, index=0):
-        """Send ICY metadata block."""
-        if self.metadata_sequence and index < len(self.metadata_sequence):
-            title = self.metadata_sequence[index]
-        else:
-            title = "Test Artist - Test Song"
+        # Frame header followed by zero padding, repeated to fill the size
+        frame = frame_header + b'\x00' * (frame_size - len(frame_header))
+        frames = (size + frame_size - 1) // frame_size
+        return (frame * frames)[:size]
 
+    @staticmethod
+    def _encode_metadata(title):
+        """Build ICY metadata block."""
         metadata = f"StreamTitle='{title}';"
 
         # Metadata length is encoded as (length / 16), padded to 16-byte boundary
@@ -232,14 +285,11 @@ class MockStreamHandler(BaseHTTPRequestHandler):
         padded_len = ((len(meta_bytes) + 15) // 16) * 16
         length_byte = padded_len // 16
 
-        # Send length byte + metadata + padding
-        self.wfile.write(bytes([length_byte]))
-        self.wfile.write(meta_bytes)
-        self.wfile.write(bytes([0] * (padded_len - len(meta_bytes))))
-        self.wfile.flush()
+        # Length byte + metadata + padding
+        return bytes([length_byte]) + meta_bytes + _ZEROS[:padded_len - len(meta_bytes)]
 
 
-class MockStreamServer(HTTPServer):
+class MockStreamServer(ThreadingHTTPServer):
     """HTTP server with configurable stream parameters."""
 
     allow_reuse_address = True
@@ -257,22 +307,121 @@ class MockStreamServer(HTTPServer):
                 - content_type: MIME type of stream
                 - drop_after_bytes: Drop connection after N bytes (0 = never)
                 - metadata_sequence: List of metadata strings to cycle
+                - max_clients: Max concurrently open streams (default: 32)
+                - no_pacing: Stream as fast as possible instead of at the
+                  bitrate (default: MOCK_NO_PACING=1 in the environment)
         """
         super().__init__(('0.0.0.0', port), MockStreamHandler)
 
-        # Configure handler class
-        MockStreamHandler.stream_file = stream_file
-        MockStreamHandler.meta_interval = kwargs.get('meta_interval', DEFAULT_META_INTERVAL)
-        MockStreamHandler.station_name = kwargs.get('station_name', 'Test Radio Station')
-        MockStreamHandler.bitrate = kwargs.get('bitrate', DEFAULT_BITRATE)
-        MockStreamHandler.content_type = kwargs.get('content_type', 'audio/mpeg')
-        MockStreamHandler.drop_after_bytes = kwargs.get('drop_after_bytes', 0)
-        MockStreamHandler.metadata_sequence = kwargs.get('metadata_sequence', [])
-
-    def serve_until_shutdown(self):
-        """Serve requests until shutdown is requested."""
-        while not _shutdown_event.is_set():
-            self.handle_request()
+        # Each connection gets its own daemon thread, so a long-running
+        # stream doesn't block other requests or interpreter exit. Cap the
+        # open streams so stress tests can't spawn unlimited threads
+        self._stream_slots = threading.BoundedSemaphore(
+            kwargs.get('max_clients', DEFAULT_MAX_CLIENTS))
+
+        # Stream configuration, copied by each handler in setup()
+        self.stream_file = stream_file
+        self.meta_interval = kwargs.get('meta_interval', DEFAULT_META_INTERVAL)
+        self.station_name = kwargs.get('station_name', 'Test Radio Station')
+        self.station_url = "http://localhost:8765"
+        self.bitrate = kwargs.get('bitrate', DEFAULT_BITRATE)
+        self.content_type = kwargs.get('content_type', 'audio/mpeg')
+        self.drop_after_bytes = kwargs.get('drop_after_bytes', 0)  # 0 = don't drop
+        self.metadata_sequence = kwargs.get('metadata_sequence', [])
+        self.no_pacing = kwargs.get('no_pacing', os.environ.get('MOCK_NO_PACING') == '1')
+        self._shutdown_event = threading.Event()
+        self._live_requests = set()  # Open connections, closed on shutdown
+        self._live_lock = threading.Lock()
+
+        # Read the fixture once so connections don't re-read it from disk.
+        # The file stays open for sendfile(), which takes explicit offsets
+        # and so can be shared between connections
+        self._stream_bytes = None
+        self._stream_file = None
+        self._stream_fd = None
+        if stream_file and os.path.exists(stream_file):
+            self._stream_file = open(stream_file, 'rb')
+            self._stream_bytes = self._stream_file.read()
+            if self._stream_bytes and hasattr(os, 'sendfile'):
+                self._stream_fd = self._stream_file.fileno()
+        if MockStreamHandler._dummy_bytes is None:
+            # Simple pattern that looks like MP3 frame headers
+            MockStreamHandler._dummy_bytes = \
+                MockStreamHandler._generate_dummy_mp3_data(64 * 1024)  # 64KB of dummy data
+
+        # Append one chunk's worth of the data's start (repeated if the
+        # data is shorter) so a chunk starting anywhere in it is one slice
+        data = self._stream_bytes or MockStreamHandler._dummy_bytes
+        window = max(self.meta_interval, STREAM_CHUNK_SIZE)
+        self._stream_len = len(data)
+        self._ring_bytes = data + (data * -(-window // len(data)))[:window]
+
+        # Frame the metadata blocks once instead of on every injection
+        self._encoded_meta = [MockStreamHandler._encode_metadata(title) for title in
+                              self.metadata_sequence or ["Test Artist - Test Song"]]
+
+        # Build the ICY response headers once instead of per connection
+        headers = ("ICY 200 OK\r\n"
+                   f"icy-name:{self.station_name}\r\n"
+                   f"icy-url:{self.station_url}\r\n"
+                   f"icy-br:{self.bitrate}\r\n"
+                   "icy-genre:Test\r\n"
+                   f"Content-Type:{self.content_type}\r\n")
+        self._icy_headers_plain = (headers + "\r\n").encode('utf-8')
+        self._icy_headers_meta = (headers +
+                                  f"icy-metaint:{self.meta_interval}\r\n\r\n").encode('utf-8')
+
+        # The settings never change while serving, so encode /config once
+        self._config_json = json.dumps({
+            'station_name': self.station_name,
+            'bitrate': self.bitrate,
+            'meta_interval': self.meta_interval,
+            'content_type': self.content_type,
+            'drop_after_bytes': self.drop_after_bytes
+        }).encode('utf-8')
+
+    def process_request(self, request, client_address):
+        """Track the connection so shutdown can unblock its thread."""
+        with self._live_lock:
+            self._live_requests.add(request)
+        # Keep per-connection memory small when many clients stream at once,
+        # without changing the stack size for the rest of the process
+        previous_stack_size = threading.stack_size(WORKER_STACK_SIZE)
+        try:
+            super().process_request(request, client_address)
+        finally:
+            threading.stack_size(previous_stack_size)
+
+    def shutdown_request(self, request):
+        """Forget the connection once its thread is done with it."""
+        with self._live_lock:
+            self._live_requests.discard(request)
+        super().shutdown_request(request)
+
+    def server_close(self):
+        """Close the listening socket and the stream fixture."""
+        super().server_close()
+        if self._stream_file:
+            self._stream_file.close()
+
+    def request_shutdown(self):
+        """Stop open streams and the accept loop without blocking the caller."""
+        self._shutdown_event.set()
+
+        # Paced streams wake on the event, but a thread blocked sending to a
+        # client that stopped reading, or waiting for a request line that
+        # never comes, only returns once its socket is shut down
+        with self._live_lock:
+            live_requests = list(self._live_requests)
+        for request in live_requests:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # Already closed by the client
+
+        # shutdown() waits for serve_forever() to return, so call it from
+        # a one-shot thread rather than from a request handler
+        threading.Thread(target=self.shutdown, daemon=True).start()
 
 
 def start_server(port=DEFAULT_PORT, stream_file=None, background=False, **kwargs):
@@ -289,11 +438,11 @@ def start_server(port=DEFAULT_PORT, stream_file=None, background=False, **kwargs
     """
     global _server_instance
 
-    _shutdown_event.clear()
     _server_instance = MockStreamServer(port, stream_file, **kwargs)
 
     if background:
-        thread = threading.Thread(target=_server_instance.serve_until_shutdown)
+        thread = threading.Thread(target=_server_instance.serve_forever,
+                                  kwargs={'poll_interval': POLL_INTERVAL})
         thread.daemon = True
         thread.start()
         return _server_instance
@@ -301,17 +450,18 @@ def start_server(port=DEFAULT_PORT, stream_file=None, background=False, **kwargs
         print(f"Mock streaming server running on port {port}")
         print("Press Ctrl+C or GET /shutdown to stop")
         try:
-            _server_instance.serve_until_shutdown()
+            _server_instance.serve_forever(poll_interval=POLL_INTERVAL)
         except KeyboardInterrupt:
-            pass
+            _server_instance.request_shutdown()
         finally:
             _server_instance.server_close()
 
 
 def stop_server():
     """Stop the mock server."""
-    _shutdown_event.set()
     if _server_instance:
+        _server_instance.request_shutdown()
+        _server_instance.shutdown()
         _server_instance.server_close()
 
 
@@ -326,16 +476,14 @@ def wait_for_server(host='localhost', port=DEFAULT_PORT, timeout=5):
     Returns:
         True if server is ready, False if timeout
     """
-    import urllib.request
-    import urllib.error
-
     start = time.time()
     while time.time() - start < timeout:
         try:
-            urllib.request.urlopen(f'http://{host}:{port}/status', timeout=1)
+            # The listening socket accepting a connection means we're ready
+            socket.create_connection((host, port), timeout=0.2).close()
             return True
-        except (urllib.error.URLError, socket.timeout):
-            time.sleep(0.1)
+        except OSError:
+            time.sleep(0.05)
     return False
 
 
@@ -358,6 +506,8 @@ def main():
                        help='Drop connection after N bytes (for reconnect testing)')
     parser.add_argument('--metadata', type=str, nargs='*', default=[],
                        help='Metadata strings to cycle through')
+    parser.add_argument('--max-clients', type=int, default=DEFAULT_MAX_CLIENTS,
+                       help=f'Max concurrently open streams (default: {DEFAULT_MAX_CLIENTS})')
 
     args = parser.parse_args()
 
@@ -369,7 +519,8 @@ def main():
         bitrate=args.bitrate,
         content_type=args.content_type,
         drop_after_bytes=args.drop_after,
-        metadata_sequence=args.metadata
+        metadata_sequence=args.metadata,
+        max_clients=args.max_clients
     )
 
 